@@ -1,6 +1,12 @@
+import asyncio
 import enum
+import math
+import os
 import traceback
+from dataclasses import dataclass, field
+from functools import lru_cache
 from pathlib import Path
+from typing import ClassVar
 
 from pydantic import BaseModel, Field
 from pydantic_ai import RunContext, ToolOutput
@@ -8,6 +14,7 @@ from pydantic_ai.agent import Agent
 from pydantic_ai.messages import (
     ModelMessage,
     ModelRequest,
+    ModelRequestPart,
     ModelResponse,
     SystemPromptPart,
     TextPart,
@@ -20,21 +27,46 @@ from pydantic_ai.usage import Usage
 
 from pydantic_ai_history_processor.log import logger
 from pydantic_ai_history_processor.utils import (
-    extract_system_prompts,
-    fix_system_prompt,
+    extract_and_strip,
     get_current_token_consumption,
 )
 
 _HERE = Path(__file__).parent
-SYSTEM_PROMPT = (_HERE / "compactor_system_prompt.md").read_text()
+
+
+@lru_cache(maxsize=1)
+def _load_system_prompt() -> str:
+    return Path(
+        os.getenv("PYDANTIC_AI_HISTORY_PROCESSOR_COMPACTOR_SYSTEM_PROMPT_PATH", _HERE / "compactor_system_prompt.md")
+    ).read_text()
+
+
+def __getattr__(name: str):
+    # Keep `SYSTEM_PROMPT` importable without reading the file at import time
+    if name == "SYSTEM_PROMPT":
+        return _load_system_prompt()
+    raise AttributeError(name)
+
+
+COMPACT_PROMPT = (
+    "The user has accepted the condensed conversation summary you generated. Use `condense` to generate a summary and context of the conversation so far. "
+    "This summary covers important details of the historical conversation with the user which has been truncated. "
+    "It's crucial that you respond by ONLY asking the user what you should work on next. "
+    "You should NOT take any initiative or make any assumptions about continuing with work. "
+    "Keep this response CONCISE and wrap your analysis in <analysis> and <context> tags to organize your thoughts and ensure you've covered all necessary points. "
+)
 
 K_TOKENS_1000 = 1000
 K_TOKENS = 1024
 
+# Evict the token cache once it holds this many entries per message in the history
+_TOKEN_CACHE_EVICT_RATIO = 2
+
 
-class CompactContext(BaseModel):
+@dataclass(slots=True)
+class CompactContext:
     compacted_messages: list[ModelMessage] | None = None
-    compactor_usage: Usage = Field(default_factory=Usage)
+    compactor_usage: Usage = field(default_factory=Usage)
 
 
 class CondenseResult(BaseModel):
@@ -58,6 +90,15 @@ class CondenseResult(BaseModel):
     )
 
 
+@dataclass
+class _PendingSummary:
+    task: asyncio.Task[tuple[list[ModelMessage], Usage]]
+    placeholder: tuple[ModelRequest, ModelResponse]
+    history: list[ModelMessage]
+    """The history before compaction, restored if summarizing fails"""
+    keep_length: int
+
+
 class Feature(str, enum.Enum):
     refine_prompt = "refine_prompt"
 
@@ -74,6 +115,25 @@ class CompactStrategy(str, enum.Enum):
 
 
 class CompactorProcessor:
+    """Compact the message history with a summary once it reaches the threshold.
+
+    With `background_compact`, the history is trimmed immediately behind a placeholder summary,
+    which is replaced on a later call once the summary is ready. This requires feeding
+    `compacted_messages` back as the message history, and one processor per conversation.
+
+    With `compact_block_size`, the history is split into blocks of at least that many messages
+    at user prompt boundaries, and the blocks are summarized concurrently.
+    """
+
+    _STRATEGY_N: ClassVar[dict[CompactStrategy, int]] = {
+        # Only current 1
+        CompactStrategy.none: 1,
+        # Previous 2 + current 1
+        CompactStrategy.last_two: 3,
+        # Current 1 and its tool calls, compacting the rest of this round
+        CompactStrategy.in_conversation: 0,
+    }
+
     def __init__(
         self,
         model: Model | KnownModelName,
@@ -85,14 +145,25 @@ class CompactorProcessor:
         system_prompt: str | None = None,
         *,
         compact_agent: Agent = None,
+        background_compact: bool = False,
+        compact_block_size: int | None = None,
     ):
         self.model_context_window = model_context_window
         self.model_settings = model_settings or {}
         self.compact_threshold = compact_threshold
         self.in_conversation_compact_threshold = in_conversation_compact_threshold
+        # Precomputed for `need_compact`, which runs several times per turn.
+        # Token counts are integers, so rounding thresholds up keeps `>=` exact.
+        self._compact_abs = math.ceil(self.compact_threshold * self.model_context_window)
+        self._overflow_limit = self.model_context_window - self.model_settings.get("max_tokens", 0)
 
         self.compact_strategy = CompactStrategy.last_two
-        self.system_prompt = system_prompt or SYSTEM_PROMPT
+        # id(msg) -> (msg, tokens), pruned to messages still in the history once it grows too large
+        self._token_cache: dict[int, tuple[ModelMessage, int]] = {}
+        self.background_compact = background_compact
+        self.compact_block_size = compact_block_size
+        self._pending_summary: _PendingSummary | None = None
+        self.system_prompt = system_prompt or _load_system_prompt()
         if compact_agent:
             self.agent = compact_agent
         else:
@@ -113,36 +184,61 @@ Users may refer to this tool as 'smol' or 'compact' as well. You should consider
                 retries=3,
             )
 
+    @staticmethod
+    def _is_user_prompt(msg: ModelMessage) -> bool:
+        """
+        Returns True if the message is a user prompt rather than a tool return
+        """
+        if not isinstance(msg, ModelRequest):
+            return False
+        has_user_prompt = False
+        for p in msg.parts:
+            part_type = type(p)
+            if part_type is UserPromptPart:
+                has_user_prompt = True
+            elif part_type is ToolReturnPart:
+                return False
+        return has_user_prompt
+
+    def _user_prompt_indices(self, message_history: list[ModelMessage], n: int) -> list[int]:
+        """
+        Returns indices of the last `n` user prompts, latest first
+        """
+        user_prompt_indices = []
+        # Scan backwards, only the last `n` user prompts matter
+        for i in range(len(message_history) - 1, -1, -1):
+            if self._is_user_prompt(message_history[i]):
+                user_prompt_indices.append(i)
+                if len(user_prompt_indices) >= n:
+                    break
+        return user_prompt_indices
+
     def _split_history(
         self,
         message_history: list[ModelMessage],
         n: int,
+        user_prompt_indices: list[int] | None = None,
     ) -> tuple[list[ModelMessage], list[ModelMessage]]:
         """
         Returns a tuple of (history, keep_messages)
+
+        `user_prompt_indices` from `_user_prompt_indices` can be shared between splits to avoid rescanning.
         """
         if not message_history:
             return [], []
 
-        user_prompt_indices = []
-        for i, msg in enumerate(message_history):
-            if not isinstance(msg, ModelRequest):
-                continue
-            if any(isinstance(p, UserPromptPart) for p in msg.parts) and not any(
-                isinstance(p, ToolReturnPart) for p in msg.parts
-            ):
-                user_prompt_indices.append(i)
+        if user_prompt_indices is None:
+            user_prompt_indices = self._user_prompt_indices(message_history, n or 1)
         if not user_prompt_indices:
             # No user prompt in history, keep all
             return [], message_history
 
         if not n:
             # Keep current user prompt and compact all
-            keep_messages = []
-            last_model_request: ModelRequest = message_history[user_prompt_indices[-1]]
-            keep_messages.append(last_model_request)
+            last_model_request = message_history[user_prompt_indices[0]]
+            keep_messages = [last_model_request]
             logger.info(f"Last model request: {last_model_request}")
-            if any(isinstance(p, ToolReturnPart) for p in message_history[-1].parts):
+            if any(type(p) is ToolReturnPart for p in message_history[-1].parts):
                 # Include last tool-call and tool-return pair
                 keep_messages.extend(message_history[-2:])
             return message_history, keep_messages
@@ -151,34 +247,27 @@ Users may refer to this tool as 'smol' or 'compact' as well. You should consider
             # No enough history to keep
             logger.warning(f"History too short to keep {n} messages, will keep all")
             return [], message_history
-        return (
-            message_history[: user_prompt_indices[-n]],
-            message_history[user_prompt_indices[-n] :],
-        )
+        split_index = user_prompt_indices[n - 1]
+        return message_history[:split_index], message_history[split_index:]
 
     def split_history(
         self,
         message_history: list[ModelMessage],
         compact_strategy: CompactStrategy | None = None,
+        user_prompt_indices: list[int] | None = None,
     ) -> tuple[list[ModelMessage], list[ModelMessage]]:
         compact_strategy = compact_strategy or self.compact_strategy
-        match compact_strategy:
-            case CompactStrategy.none:
-                # Only current 1
-                history_messages, keep_messages = self._split_history(message_history, 1)
-            case CompactStrategy.last_two:
-                # Previous 2 + current 1
-                history_messages, keep_messages = self._split_history(message_history, 3)
-            case CompactStrategy.in_conversation:
-                history_messages, keep_messages = self._split_history(message_history, 0)
-            case _:
-                raise NotImplementedError(f"Compact strategy {self.model_config.compact_strategy} not implemented")
-
-        return history_messages, keep_messages
+        n = self._STRATEGY_N.get(compact_strategy)
+        if n is None:
+            raise NotImplementedError(f"Compact strategy {compact_strategy} not implemented")
+        return self._split_history(message_history, n, user_prompt_indices)
 
     async def __call__(
         self, ctx: RunContext[CompactContext], message_history: list[ModelMessage]
     ) -> list[ModelMessage]:
+        if len(self._token_cache) > _TOKEN_CACHE_EVICT_RATIO * len(message_history):
+            # Evict lazily, a full pass on every call would cost more than the lookups it saves
+            self._token_cache = {id(m): self._token_cache[id(m)] for m in message_history if id(m) in self._token_cache}
         try:
             message_history = await self._compact(ctx, message_history)
         except Exception as e:
@@ -188,58 +277,105 @@ Users may refer to this tool as 'smol' or 'compact' as well. You should consider
         return message_history
 
     def need_compact(self, message_history: list[ModelMessage], threshold: float | None = None) -> bool:
-        current_token_comsumption = get_current_token_consumption(message_history)
+        current_token_comsumption = get_current_token_consumption(message_history, self._token_cache) or 0
 
-        token_threshold = (threshold or self.compact_threshold) * self.model_context_window
-        will_overflow = (current_token_comsumption or 0) + self.model_settings.get(
-            "max_tokens", 0
-        ) >= self.model_context_window
+        token_threshold = (
+            math.ceil(threshold * self.model_context_window) if threshold is not None else self._compact_abs
+        )
+        will_overflow = current_token_comsumption >= self._overflow_limit
         logger.info(
             f"Current token consumption: {current_token_comsumption} vs {token_threshold}, will overflow: {will_overflow}"
         )
 
-        return (current_token_comsumption and current_token_comsumption >= token_threshold) or will_overflow
+        return will_overflow or (current_token_comsumption > 0 and current_token_comsumption >= token_threshold)
 
-    async def _compact(
-        self, ctx: RunContext[CompactContext], message_history: list[ModelMessage]
-    ) -> list[ModelMessage]:
-        ctx = ctx.deps
-        if not self.need_compact(message_history):
-            logger.info("No need to compact history.")
-            return message_history
-        original_system_prompts = extract_system_prompts(message_history)
+    def _build_summary_request(self, original_system_prompts: list[str]) -> ModelRequest:
+        """
+        Returns the request that replaces the compacted history, carrying the original system prompts
+        """
+        parts: list[ModelRequestPart] = [SystemPromptPart(content=p) for p in original_system_prompts]
+        parts.append(UserPromptPart(content="Please summary the conversation"))
+        return ModelRequest(parts=parts)
+
+    def _split_for_compact(self, message_history: list[ModelMessage]) -> tuple[list[ModelMessage], list[ModelMessage]]:
+        """
+        Returns a tuple of (history, keep_messages), falling back to more aggressive strategies if needed.
+
+        Empty history means nothing to summarize, keep_messages should be used as is.
+        """
         logger.info("Splitting history for compaction...")
-        history_messages, keep_messages = self.split_history(message_history)
+        # One scan serves every strategy in the fallback chain
+        user_prompt_indices = self._user_prompt_indices(message_history, max(self._STRATEGY_N.values()))
+        history_messages, keep_messages = self.split_history(message_history, None, user_prompt_indices)
         if len(history_messages) <= 2:
             logger.info("No enough history to compact, try compacting all history.")
-            history_messages, keep_messages = self.split_history(message_history, CompactStrategy.none)
+            history_messages, keep_messages = self.split_history(
+                message_history, CompactStrategy.none, user_prompt_indices
+            )
             if len(history_messages) <= 2:
                 if self.need_compact(message_history, 0.8):
                     logger.info("No enough history to compact, try compacting in conversation.")
                     history_messages, keep_messages = self.split_history(
-                        message_history, CompactStrategy.in_conversation
+                        message_history, CompactStrategy.in_conversation, user_prompt_indices
                     )
                 else:
                     logger.info("Already compacted all history, skipping.")
-                    return keep_messages
+                    return [], keep_messages
         if not history_messages:
             logger.info("No history to compact, keeping all messages.")
-            return keep_messages
-        logger.info(
-            f"Compacting history... {len(message_history)}({len(history_messages)}, {len(keep_messages)}) -> {len(keep_messages)}"
+        return history_messages, keep_messages
+
+    def _split_blocks(self, history_messages: list[ModelMessage]) -> list[list[ModelMessage]]:
+        """
+        Returns blocks of at least `compact_block_size` messages, each block starts at a user prompt
+        so tool calls and tool returns stay together.
+        """
+        if not self.compact_block_size:
+            return [history_messages]
+        blocks: list[list[ModelMessage]] = [[]]
+        for msg in history_messages:
+            if len(blocks[-1]) >= self.compact_block_size and self._is_user_prompt(msg):
+                blocks.append([])
+            blocks[-1].append(msg)
+        return blocks
+
+    async def _strip_blocks(self, history_messages: list[ModelMessage]) -> tuple[list[str], list[list[ModelMessage]]]:
+        """
+        Returns a tuple of (system_prompts, blocks), blocks to summarize have system prompts replaced
+        and are new lists detached from `history_messages`
+        """
+        blocks = self._split_blocks(history_messages)
+        # Stripping system prompts walks the whole history, keep it off the event loop
+        stripped_blocks = await asyncio.to_thread(
+            lambda: [extract_and_strip(block, self.system_prompt) for block in blocks]
         )
-        result = await self.agent.run(
-            "The user has accepted the condensed conversation summary you generated. Use `condense` to generate a summary and context of the conversation so far. "
-            "This summary covers important details of the historical conversation with the user which has been truncated. "
-            "It's crucial that you respond by ONLY asking the user what you should work on next. "
-            "You should NOT take any initiative or make any assumptions about continuing with work. "
-            "Keep this response CONCISE and wrap your analysis in <analysis> and <context> tags to organize your thoughts and ensure you've covered all necessary points. ",
-            message_history=fix_system_prompt(history_messages, self.system_prompt),
+        # System prompts sit at the top of the conversation, which is the first block
+        return stripped_blocks[0][0], [block for _, block in stripped_blocks]
+
+    async def _compact_history(
+        self, stripped_blocks: list[list[ModelMessage]], summary_request: ModelRequest
+    ) -> tuple[list[ModelMessage], Usage]:
+        """
+        Returns a tuple of (summary_messages, usage), summary_messages replaces the summarized history
+        """
+        results = await asyncio.gather(
+            *(self.agent.run(COMPACT_PROMPT, message_history=block) for block in stripped_blocks)
         )
-        ctx.compactor_usage += result.usage()
 
-        summary_prompt = f"""Condensed conversation summary(not in the history):
-<condense>
+        usage = Usage()
+        for result in results:
+            usage += result.usage()
+        if len(results) == 1:
+            condensed = f"""<analysis>
+{results[0].output.analysis}
+</analysis>
+
+<context>
+{results[0].output.context}
+</context>"""
+        else:
+            condensed = "\n\n".join(
+                f"""<block i="{i}">
 <analysis>
 {result.output.analysis}
 </analysis>
@@ -247,25 +383,106 @@ Users may refer to this tool as 'smol' or 'compact' as well. You should consider
 <context>
 {result.output.context}
 </context>
+</block>"""
+                for i, result in enumerate(results)
+            )
+        summary_prompt = f"""Condensed conversation summary(not in the history):
+<condense>
+{condensed}
 </condense>
 """
         logger.info(
             f"""
 {summary_prompt}
 
-compact token usage: {result.usage()}
+compact token usage: {usage}
 """
         )
 
         return [
-            ModelRequest(
-                parts=[
-                    *[SystemPromptPart(content=p) for p in original_system_prompts],
-                    UserPromptPart(content="Please summary the conversation"),
-                ]
-            ),
+            summary_request,
             ModelResponse(
                 parts=[TextPart(content=summary_prompt)],
             ),
-            *keep_messages,
-        ]
+        ], usage
+
+    def _apply_pending_summary(
+        self, ctx: CompactContext, message_history: list[ModelMessage]
+    ) -> list[ModelMessage] | None:
+        """
+        Returns the history with the placeholder replaced by the finished summary, None if there is nothing to apply
+        """
+        pending = self._pending_summary
+        if not (
+            len(message_history) >= 2
+            and message_history[0] is pending.placeholder[0]
+            and message_history[1] is pending.placeholder[1]
+        ):
+            if pending.task.done():
+                self._pending_summary = None
+                if not pending.task.cancelled() and not pending.task.exception():
+                    # Tokens were spent even though the summary is not used
+                    ctx.compactor_usage += pending.task.result()[1]
+                logger.warning("Placeholder summary not found in history, dropping background summary.")
+            # The compacted history was not fed back, this history still needs checking
+            return None
+        if not pending.task.done():
+            logger.info("Summary is still in progress, keeping current history.")
+            return message_history
+        self._pending_summary = None
+
+        error = None if pending.task.cancelled() else pending.task.exception()
+        if pending.task.cancelled() or error:
+            logger.error(f"Failed to compact history in background: {error!r}")
+            # Restore the original history, including messages added since
+            return [*pending.history, *message_history[2 + pending.keep_length :]]
+
+        summary_messages, usage = pending.task.result()
+        logger.info("Applying background summary.")
+        ctx.compactor_usage += usage
+        summary_messages.extend(message_history[2:])
+        return summary_messages
+
+    async def _compact(
+        self, ctx: RunContext[CompactContext], message_history: list[ModelMessage]
+    ) -> list[ModelMessage]:
+        ctx = ctx.deps
+        if self._pending_summary is not None:
+            applied_messages = self._apply_pending_summary(ctx, message_history)
+            if applied_messages is not None:
+                return applied_messages
+        if not self.need_compact(message_history):
+            logger.info("No need to compact history.")
+            return message_history
+        history_messages, keep_messages = self._split_for_compact(message_history)
+        if not history_messages:
+            return keep_messages
+        logger.info(
+            f"Compacting history... {len(message_history)}({len(history_messages)}, {len(keep_messages)}) -> {len(keep_messages)}"
+        )
+
+        # Only one summary runs in background, compact in place while it is in progress
+        # Stripping before summarizing also snapshots the history, which the caller may keep appending to
+        original_system_prompts, stripped_blocks = await self._strip_blocks(history_messages)
+        summary_request = self._build_summary_request(original_system_prompts)
+
+        if self.background_compact and self._pending_summary is None:
+            placeholder = (
+                summary_request,
+                ModelResponse(parts=[TextPart(content="[summarizing...]")]),
+            )
+            self._pending_summary = _PendingSummary(
+                # The summary reuses the placeholder request, keeping system prompts unchanged on swap
+                task=asyncio.create_task(self._compact_history(stripped_blocks, summary_request)),
+                placeholder=placeholder,
+                history=list(message_history),
+                keep_length=len(keep_messages),
+            )
+            # keep_messages is always a fresh list here, prepend in place
+            keep_messages[:0] = placeholder
+            return keep_messages
+
+        summary_messages, usage = await self._compact_history(stripped_blocks, summary_request)
+        ctx.compactor_usage += usage
+        keep_messages[:0] = summary_messages
+        return keep_messages
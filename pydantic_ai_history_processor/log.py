@@ -2,8 +2,22 @@ import os
 
 USER_DEFINED_LOG_LEVEL = os.getenv("PYDANTIC_AI_HISTORY_PROCESSOR_LOG_LEVEL", "INFO")
 
+# Must be set before anything imports loguru, including the host application
 os.environ["LOGURU_LEVEL"] = USER_DEFINED_LOG_LEVEL
 
-from loguru import logger  # noqa: E402
+
+class _LazyLogger:
+    """Defer importing loguru until the first log call."""
+
+    def __getattr__(self, name):
+        from loguru import logger
+
+        # Only called for missing attributes, cache them so later calls skip this
+        attr = getattr(logger, name)
+        setattr(self, name, attr)
+        return attr
+
+
+logger = _LazyLogger()
 
 __all__ = ["logger"]
@@ -1,7 +1,9 @@
 import os
+from dataclasses import dataclass
 
 from pydantic_ai import Agent
 from pydantic_ai.messages import (
+    ModelMessage,
     ModelRequest,
     ModelResponse,
     TextPart,
@@ -20,6 +22,21 @@ MODEL_NAME = os.getenv("MODEL_NAME", "openai:gpt-4.1")
 COMPACTOR_MODEL_NAME = os.getenv("COMPACTOR_MODEL_NAME", "openai:gpt-4.1")
 
 
+# Built once and shared between runs, the messages are never modified
+_MOCK_HISTORY: tuple[ModelMessage, ...] = (
+    ModelRequest(parts=[UserPromptPart(content="Hello")]),
+    ModelResponse(
+        parts=[TextPart(content="Hello! May I help you?")],
+    ),
+    ModelRequest(parts=[UserPromptPart(content="Got some request for you")]),
+    ModelResponse(
+        parts=[TextPart(content="Please tell me")],
+        usage=Usage(total_tokens=200),
+    ),
+)
+
+
+@dataclass(slots=True)
 class AgentContext(CompactContext):
     """Add your agent context here."""
 
@@ -46,17 +63,7 @@ async def stream_agent():
     async with agent.iter(
         "Please just tell me a joke",
         # Now we mock the history for testing compactor
-        message_history=[
-            ModelRequest(parts=[UserPromptPart(content="Hello")]),
-            ModelResponse(
-                parts=[TextPart(content="Hello! May I help you?")],
-            ),
-            ModelRequest(parts=[UserPromptPart(content="Got some request for you")]),
-            ModelResponse(
-                parts=[TextPart(content="Please tell me")],
-                usage=Usage(total_tokens=200),
-            ),
-        ],
+        message_history=list(_MOCK_HISTORY),
         deps=ctx,
     ) as run:
         async for node in run:
@@ -1,41 +1,125 @@
 from pydantic_ai.messages import ModelMessage, ModelRequest, ModelResponse, SystemPromptPart
 
 
-def fix_system_prompt(message_history: list[ModelMessage], system_prompt: str) -> list[ModelMessage]:
+def _strip_system_prompts(msg: ModelRequest, system_prompts: list[str] | None) -> ModelRequest:
+    """
+    Returns the request without system prompts, reused as is if it has none.
+
+    Leading system prompts are appended to `system_prompts` if given.
+    """
+    parts = None
+    for i, part in enumerate(msg.parts):
+        if type(part) is SystemPromptPart:
+            if parts is None:
+                parts = msg.parts[:i]
+            if system_prompts is not None and not parts:
+                system_prompts.append(part.content)
+        elif parts is not None:
+            parts.append(part)
+    if parts is None:
+        return msg
+    return ModelRequest(parts=parts, instructions=msg.instructions)
+
+
+def extract_and_strip(message_history: list[ModelMessage], system_prompt: str) -> tuple[list[str], list[ModelMessage]]:
+    """
+    Returns a tuple of (system_prompts, message_history) in a single pass over the history.
+
+    All system prompts are stripped, then `system_prompt` is injected into the first request.
+    Only the leading system prompts are collected, the same ones `extract_system_prompts` returns.
+    """
+    system_prompts = []
     if not message_history:
-        return message_history
+        return system_prompts, message_history
 
     message_history_without_system = []
+    leading = True
     for msg in message_history:
-        # Filter out system prompts
         if not isinstance(msg, ModelRequest):
             message_history_without_system.append(msg)
             continue
-        message_history_without_system.append(
-            ModelRequest(
-                parts=[part for part in msg.parts if not isinstance(part, SystemPromptPart)],
-                instructions=msg.instructions,
-            )
+        if leading and not (msg.parts and type(msg.parts[0]) is SystemPromptPart):
+            leading = False
+        message_history_without_system.append(_strip_system_prompts(msg, system_prompts if leading else None))
+    first_message = message_history_without_system[0]
+    if isinstance(first_message, ModelRequest):
+        # inject system prompt, the first message may still be the caller's
+        message_history_without_system[0] = ModelRequest(
+            parts=[SystemPromptPart(content=system_prompt), *first_message.parts],
+            instructions=first_message.instructions,
+        )
+
+    return system_prompts, message_history_without_system
+
+
+def fix_system_prompt(message_history: list[ModelMessage], system_prompt: str) -> list[ModelMessage]:
+    if not message_history:
+        return message_history
+
+    first_message = message_history[0]
+    if (
+        isinstance(first_message, ModelRequest)
+        and first_message.parts
+        and type(first_message.parts[0]) is SystemPromptPart
+        and first_message.parts[0].content == system_prompt
+        and not any(type(part) is SystemPromptPart for part in first_message.parts[1:])
+        and not any(
+            type(part) is SystemPromptPart
+            for msg in message_history[1:]
+            if isinstance(msg, ModelRequest)
+            for part in msg.parts
         )
-    if message_history_without_system and isinstance(message_history_without_system[0], ModelRequest):
-        # inject system prompt
-        message_history_without_system[0].parts.insert(0, SystemPromptPart(content=system_prompt))
+    ):
+        # Already patched, nothing to rebuild
+        return message_history
 
-    return message_history_without_system
+    _, fixed_message_history = extract_and_strip(message_history, system_prompt)
+    return fixed_message_history
 
 
 def extract_system_prompts(message_history: list[ModelMessage]) -> list[str]:
+    """
+    Returns the leading system prompts of the conversation.
+
+    System prompts are expected only at the top of the conversation,
+    the scan stops at the first request which does not start with one.
+    """
     system_prompts = []
     for msg in message_history:
-        if isinstance(msg, ModelRequest) and isinstance(msg.parts[0], SystemPromptPart):
-            system_prompts.append(msg.parts[0].content)
+        if not isinstance(msg, ModelRequest):
+            continue
+        if not msg.parts or type(msg.parts[0]) is not SystemPromptPart:
+            break
+        for part in msg.parts:
+            if type(part) is not SystemPromptPart:
+                break
+            system_prompts.append(part.content)
     return system_prompts
 
 
-def get_current_token_consumption(message_history: list[ModelMessage]) -> int | None:
-    current_token_comsumption = None
+def get_message_tokens(msg: ModelMessage) -> int:
+    if isinstance(msg, ModelResponse):
+        return msg.usage.total_tokens or 0
+    return 0
+
+
+def get_current_token_consumption(
+    message_history: list[ModelMessage],
+    token_cache: dict[int, tuple[ModelMessage, int]] | None = None,
+) -> int | None:
+    """
+    Returns the token consumption reported by the last model response, None if unknown.
+
+    `token_cache` maps `id(msg)` to `(msg, tokens)`, holding the message keeps the id from being reused.
+    """
     for msg in reversed(message_history):
-        if isinstance(msg, ModelResponse) and msg.usage.total_tokens:
-            current_token_comsumption = msg.usage.total_tokens
-            break
-    return current_token_comsumption
+        if token_cache is None:
+            tokens = get_message_tokens(msg)
+        else:
+            cached = token_cache.get(id(msg))
+            if cached is None:
+                cached = token_cache[id(msg)] = (msg, get_message_tokens(msg))
+            tokens = cached[1]
+        if tokens:
+            return tokens
+    return None
@@ -1,10 +1,14 @@
 from __future__ import annotations
 
+from types import SimpleNamespace
+
 import pytest
 from pydantic_ai.messages import (
     ModelMessage,
     ModelRequest,
     ModelResponse,
+    SystemPromptPart,
+    TextPart,
     ToolCallPart,
     ToolReturnPart,
     UserPromptPart,
@@ -14,8 +18,10 @@ from pydantic_ai.usage import Usage
 from pydantic_ai_history_processor.compactor import (
     K_TOKENS,
     K_TOKENS_1000,
+    CompactContext,
     CompactorProcessor,
     CompactStrategy,
+    _load_system_prompt,
 )
 
 
@@ -66,6 +72,22 @@ def test_compactor_need_compact(compactor: CompactorProcessor):
             CompactStrategy.none,
             (4, 1),
         ),
+        (
+            [
+                ModelRequest(parts=[UserPromptPart(content="Hello")]),
+                ModelResponse(parts=[]),
+                ModelRequest(parts=[UserPromptPart(content="New message")]),
+            ],
+            CompactStrategy.last_two,
+            (0, 3),
+        ),
+        (
+            [
+                ModelResponse(parts=[]),
+            ],
+            CompactStrategy.none,
+            (0, 1),
+        ),
         (
             [
                 ModelRequest(parts=[UserPromptPart(content="我在")]),
@@ -130,3 +152,257 @@ def test_compactor_split_messages(
     )
     assert len(history_messages) == history_messages_length
     assert len(keep_messages) == keep_messages_length
+
+
+async def test_compactor_compact(compactor: CompactorProcessor):
+    ctx = SimpleNamespace(deps=CompactContext())
+    messages = [
+        ModelRequest(parts=[SystemPromptPart(content="You are a helpful assistant"), UserPromptPart(content="Hello")]),
+        ModelResponse(parts=[TextPart(content="Hello!")]),
+        ModelRequest(parts=[UserPromptPart(content="World")]),
+        ModelResponse(parts=[TextPart(content="World!")]),
+        ModelRequest(parts=[UserPromptPart(content="Foo")]),
+        ModelResponse(parts=[TextPart(content="Foo!")]),
+        ModelRequest(parts=[UserPromptPart(content="Bar")]),
+        ModelResponse(parts=[TextPart(content="Bar!")], usage=Usage(total_tokens=150 * K_TOKENS_1000)),
+        ModelRequest(parts=[UserPromptPart(content="New message")]),
+    ]
+
+    compacted = await compactor(ctx, messages)
+
+    assert compacted is ctx.deps.compacted_messages
+    assert len(compacted) == 7
+    summary_request, summary_response = compacted[:2]
+    assert isinstance(summary_request.parts[0], SystemPromptPart)
+    assert summary_request.parts[0].content == "You are a helpful assistant"
+    assert "<condense>" in summary_response.parts[0].content
+    assert compacted[2:] == messages[4:]
+    assert ctx.deps.compactor_usage.requests == 1
+
+
+def test_compactor_token_cache(compactor: CompactorProcessor):
+    response = ModelResponse(parts=[], usage=Usage(total_tokens=150 * K_TOKENS_1000))
+    messages = [ModelRequest(parts=[UserPromptPart(content="Hello")]), response]
+    assert compactor.need_compact(messages)
+    assert compactor._token_cache[id(response)] == (response, 150 * K_TOKENS_1000)
+
+    # Cached value is reused across calls
+    response.usage = Usage(total_tokens=1)
+    assert compactor.need_compact(messages)
+
+
+@pytest.fixture
+def background_compactor():
+    return CompactorProcessor(
+        model="test",
+        model_settings={"max_tokens": 32 * K_TOKENS},
+        model_context_window=200 * K_TOKENS_1000,
+        background_compact=True,
+    )
+
+
+@pytest.fixture
+def background_messages():
+    return [
+        ModelRequest(parts=[SystemPromptPart(content="You are a helpful assistant"), UserPromptPart(content="Hello")]),
+        ModelResponse(parts=[TextPart(content="Hello!")]),
+        ModelRequest(parts=[UserPromptPart(content="World")]),
+        ModelResponse(parts=[TextPart(content="World!")], usage=Usage(total_tokens=150 * K_TOKENS_1000)),
+        ModelRequest(parts=[UserPromptPart(content="New message")]),
+    ]
+
+
+async def test_compactor_background_compact(
+    background_compactor: CompactorProcessor, background_messages: list[ModelMessage]
+):
+    compactor = background_compactor
+    messages = background_messages
+    ctx = SimpleNamespace(deps=CompactContext())
+
+    compacted = await compactor(ctx, messages)
+    assert len(compacted) == 3
+    assert compacted[1].parts[0].content == "[summarizing...]"
+    assert compacted[2] is messages[-1]
+    assert ctx.deps.compactor_usage.requests == 0
+
+    await compactor._pending_summary.task
+    new_messages = [
+        ModelResponse(parts=[TextPart(content="New message!")], usage=Usage(total_tokens=1)),
+        ModelRequest(parts=[UserPromptPart(content="Next message")]),
+    ]
+    placeholder_request = compacted[0]
+    compacted = await compactor(ctx, [*compacted, *new_messages])
+    assert len(compacted) == 5
+    assert compacted[0] is placeholder_request
+    assert compacted[0].parts[0].content == "You are a helpful assistant"
+    assert "<condense>" in compacted[1].parts[0].content
+    assert compacted[2] is messages[-1]
+    assert compacted[3:] == new_messages
+    assert ctx.deps.compactor_usage.requests == 1
+    assert compactor._pending_summary is None
+
+
+async def test_compactor_background_compact_failed(
+    background_compactor: CompactorProcessor, background_messages: list[ModelMessage], monkeypatch
+):
+    compactor = background_compactor
+    messages = background_messages
+    ctx = SimpleNamespace(deps=CompactContext())
+
+    async def _compact_history(*args):
+        raise RuntimeError
+
+    monkeypatch.setattr(compactor, "_compact_history", _compact_history)
+    compacted = await compactor(ctx, messages)
+    with pytest.raises(RuntimeError):
+        await compactor._pending_summary.task
+
+    new_messages = [
+        ModelResponse(parts=[TextPart(content="New message!")]),
+        ModelRequest(parts=[UserPromptPart(content="Next message")]),
+    ]
+    compacted = await compactor(ctx, [*compacted, *new_messages])
+    # Original history is restored
+    assert compacted == [*messages, *new_messages]
+    assert compactor._pending_summary is None
+
+
+async def test_compactor_background_compact_snapshot(background_compactor: CompactorProcessor, monkeypatch):
+    compactor = background_compactor
+    ctx = SimpleNamespace(deps=CompactContext())
+    # Single user prompt in a tool loop, falls back to compacting in conversation
+    messages = [
+        ModelRequest(parts=[UserPromptPart(content="Hello")]),
+        ModelResponse(parts=[ToolCallPart(tool_name="foo", tool_call_id="1")]),
+        ModelRequest(parts=[ToolReturnPart(tool_name="foo", content="", tool_call_id="1")]),
+        ModelResponse(
+            parts=[ToolCallPart(tool_name="bar", tool_call_id="2")],
+            usage=Usage(total_tokens=170 * K_TOKENS_1000),
+        ),
+        ModelRequest(parts=[ToolReturnPart(tool_name="bar", content="", tool_call_id="2")]),
+    ]
+    summarized_lengths = []
+    agent_run = compactor.agent.run
+
+    async def run(*args, message_history, **kwargs):
+        summarized_lengths.append(len(message_history))
+        return await agent_run(*args, message_history=message_history, **kwargs)
+
+    monkeypatch.setattr(compactor.agent, "run", run)
+
+    compacted = await compactor(ctx, messages)
+    assert len(compacted) == 5
+    # The caller keeps appending to its own history while the summary runs
+    messages.append(ModelResponse(parts=[TextPart(content="Done")]))
+    await compactor._pending_summary.task
+    assert summarized_lengths == [5]
+
+
+async def test_compactor_background_compact_placeholder_missing(
+    background_compactor: CompactorProcessor, background_messages: list[ModelMessage]
+):
+    compactor = background_compactor
+    messages = background_messages
+    ctx = SimpleNamespace(deps=CompactContext())
+
+    await compactor(ctx, messages)
+    pending_summary = compactor._pending_summary
+
+    # Still in progress, the untrimmed history is compacted in place
+    compacted = await compactor(ctx, messages)
+    assert "<condense>" in compacted[1].parts[0].content
+    assert compactor._pending_summary is pending_summary
+    assert ctx.deps.compactor_usage.requests == 1
+
+    # Finished but not applicable, usage is still reported
+    await pending_summary.task
+    compacted = await compactor(ctx, messages)
+    assert ctx.deps.compactor_usage.requests == 2
+    assert compacted[1].parts[0].content == "[summarizing...]"
+    assert compactor._pending_summary is not pending_summary
+
+
+async def test_compactor_compact_blocks():
+    compactor = CompactorProcessor(
+        model="test",
+        model_settings={"max_tokens": 32 * K_TOKENS},
+        model_context_window=200 * K_TOKENS_1000,
+        compact_block_size=2,
+    )
+    ctx = SimpleNamespace(deps=CompactContext())
+    messages = [
+        ModelRequest(parts=[UserPromptPart(content="Hello")]),
+        ModelResponse(parts=[ToolCallPart(tool_name="foo", tool_call_id="1")]),
+        ModelRequest(parts=[ToolReturnPart(tool_name="foo", content="", tool_call_id="1")]),
+        ModelResponse(parts=[TextPart(content="Hello!")]),
+        ModelRequest(parts=[UserPromptPart(content="World")]),
+        ModelResponse(parts=[TextPart(content="World!")]),
+        ModelRequest(parts=[UserPromptPart(content="Foo")]),
+        ModelResponse(parts=[TextPart(content="Foo!")]),
+        ModelRequest(parts=[UserPromptPart(content="Bar")]),
+        ModelResponse(parts=[TextPart(content="Bar!")]),
+        ModelRequest(parts=[UserPromptPart(content="Baz")]),
+        ModelResponse(parts=[TextPart(content="Baz!")], usage=Usage(total_tokens=150 * K_TOKENS_1000)),
+        ModelRequest(parts=[UserPromptPart(content="New message")]),
+    ]
+
+    assert [len(block) for block in compactor._split_blocks(messages[:6])] == [4, 2]
+
+    compacted = await compactor(ctx, messages)
+
+    assert len(compacted) == 7
+    summary = compacted[1].parts[0].content
+    assert '<block i="0">' in summary
+    assert '<block i="2">' in summary
+    assert ctx.deps.compactor_usage.requests == 3
+
+
+def test_compactor_shared_user_prompt_indices(compactor: CompactorProcessor):
+    messages = [
+        ModelRequest(parts=[UserPromptPart(content="Hello")]),
+        ModelResponse(parts=[]),
+        ModelRequest(parts=[UserPromptPart(content="World")]),
+        ModelResponse(parts=[]),
+        ModelRequest(parts=[UserPromptPart(content="Foo")]),
+        ModelResponse(parts=[]),
+        ModelRequest(parts=[UserPromptPart(content="New message")]),
+    ]
+
+    user_prompt_indices = compactor._user_prompt_indices(messages, 3)
+    assert user_prompt_indices == [6, 4, 2]
+    for compact_strategy in CompactStrategy:
+        assert compactor.split_history(messages, compact_strategy, user_prompt_indices) == compactor.split_history(
+            messages, compact_strategy
+        )
+
+
+def test_compactor_system_prompt_path(tmp_path, monkeypatch):
+    system_prompt_path = tmp_path / "system_prompt.md"
+    system_prompt_path.write_text("Summarize")
+    monkeypatch.setenv("PYDANTIC_AI_HISTORY_PROCESSOR_COMPACTOR_SYSTEM_PROMPT_PATH", str(system_prompt_path))
+    _load_system_prompt.cache_clear()
+    try:
+        assert CompactorProcessor(model="test").system_prompt == "Summarize"
+    finally:
+        _load_system_prompt.cache_clear()
+    assert CompactorProcessor(model="test", system_prompt="Custom").system_prompt == "Custom"
+
+
+async def test_compactor_token_cache_eviction(compactor: CompactorProcessor):
+    ctx = SimpleNamespace(deps=CompactContext())
+    stale = [ModelResponse(parts=[], usage=Usage(total_tokens=1)) for _ in range(4)]
+    for msg in stale:
+        compactor.need_compact([msg])
+    messages = [
+        ModelRequest(parts=[UserPromptPart(content="Hello")]),
+        ModelResponse(parts=[], usage=Usage(total_tokens=1)),
+    ]
+
+    # Small enough, kept as is
+    await compactor(ctx, messages)
+    assert len(compactor._token_cache) == 5
+
+    # Grown past the limit, pruned to the current history
+    compactor.need_compact([ModelResponse(parts=[], usage=Usage(total_tokens=1))])
+    await compactor(ctx, messages)
+    assert list(compactor._token_cache) == [id(messages[1])]
@@ -0,0 +1,102 @@
+from __future__ import annotations
+
+from pydantic_ai.messages import (
+    ModelRequest,
+    ModelResponse,
+    SystemPromptPart,
+    TextPart,
+    UserPromptPart,
+)
+
+from pydantic_ai_history_processor.utils import extract_and_strip, extract_system_prompts, fix_system_prompt
+
+
+def test_fix_system_prompt():
+    messages = [
+        ModelRequest(parts=[SystemPromptPart(content="Old"), UserPromptPart(content="Hello")]),
+        ModelResponse(parts=[TextPart(content="Hello!")]),
+        ModelRequest(parts=[SystemPromptPart(content="Injected"), UserPromptPart(content="World")]),
+        ModelResponse(parts=[TextPart(content="World!")]),
+        ModelRequest(parts=[UserPromptPart(content="New message")]),
+    ]
+
+    fixed = fix_system_prompt(messages, "New")
+
+    assert len(fixed) == len(messages)
+    assert [type(p) for p in fixed[0].parts] == [SystemPromptPart, UserPromptPart]
+    assert fixed[0].parts[0].content == "New"
+    assert [type(p) for p in fixed[2].parts] == [UserPromptPart]
+    # Messages without system prompts are reused
+    assert fixed[1] is messages[1]
+    assert fixed[4] is messages[4]
+    # Input is not modified
+    assert messages[0].parts[0].content == "Old"
+
+
+def test_fix_system_prompt_without_system_prompt():
+    messages = [
+        ModelRequest(parts=[UserPromptPart(content="Hello")]),
+        ModelResponse(parts=[TextPart(content="Hello!")]),
+    ]
+
+    fixed = fix_system_prompt(messages, "New")
+
+    assert [type(p) for p in fixed[0].parts] == [SystemPromptPart, UserPromptPart]
+    assert len(messages[0].parts) == 1
+    assert fixed[1] is messages[1]
+    assert fix_system_prompt([ModelResponse(parts=[])], "New")[0].parts == []
+
+
+def test_extract_and_strip():
+    messages = [
+        ModelRequest(
+            parts=[SystemPromptPart(content="A"), SystemPromptPart(content="B"), UserPromptPart(content="Hello")]
+        ),
+        ModelResponse(parts=[TextPart(content="Hello!")]),
+        ModelRequest(parts=[UserPromptPart(content="World"), SystemPromptPart(content="C")]),
+    ]
+
+    system_prompts, stripped = extract_and_strip(messages, "New")
+
+    # Only leading system prompts are collected, all of them are stripped
+    assert system_prompts == ["A", "B"] == extract_system_prompts(messages)
+    assert [p.content for p in stripped[0].parts] == ["New", "Hello"]
+    assert [p.content for p in stripped[2].parts] == ["World"]
+    assert extract_and_strip([], "New") == ([], [])
+
+
+def test_extract_system_prompts():
+    messages = [
+        ModelRequest(
+            parts=[SystemPromptPart(content="A"), SystemPromptPart(content="B"), UserPromptPart(content="Hello")]
+        ),
+        ModelResponse(parts=[TextPart(content="Hello!")]),
+        ModelRequest(parts=[UserPromptPart(content="World")]),
+        ModelRequest(parts=[SystemPromptPart(content="C"), UserPromptPart(content="Ignored")]),
+    ]
+
+    assert extract_system_prompts(messages) == ["A", "B"]
+    assert extract_system_prompts([ModelRequest(parts=[])]) == []
+
+
+def test_fix_system_prompt_already_fixed():
+    messages = [
+        ModelRequest(parts=[SystemPromptPart(content="New"), UserPromptPart(content="Hello")]),
+        ModelResponse(parts=[TextPart(content="Hello!")]),
+        ModelRequest(parts=[UserPromptPart(content="World")]),
+    ]
+
+    assert fix_system_prompt(messages, "New") is messages
+    assert fix_system_prompt(fix_system_prompt(messages, "Other"), "Other")[0].parts[0].content == "Other"
+
+    messages.append(ModelRequest(parts=[SystemPromptPart(content="New")]))
+    fixed = fix_system_prompt(messages, "New")
+    assert fixed is not messages
+    assert fixed[3].parts == []
+
+
+def test_fix_system_prompt_fresh_part():
+    messages = [ModelRequest(parts=[UserPromptPart(content="Hello")])]
+
+    # Injected parts are never shared between histories
+    assert fix_system_prompt(messages, "New")[0].parts[0] is not fix_system_prompt(messages, "New")[0].parts[0]